@@ -96,9 +96,6 @@ class PythonP2PService {
         // Setup Socket.IO connection
         _setupSocket();
 
-        // Start heartbeat
-        _startHeartbeat();
-
         return true;
       }
       return false;
@@ -229,26 +226,6 @@ class PythonP2PService {
     });
   }
 
-  // Start heartbeat to keep connection alive
-  void _startHeartbeat() {
-    if (_peerId == null) return;
-
-    Future.doWhile(() async {
-      if (!_isConnected || _peerId == null) return false;
-
-      try {
-        await http
-            .post(Uri.parse('$serverUrl/heartbeat/$_peerId'))
-            .timeout(const Duration(seconds: 5));
-      } catch (e) {
-        debugPrint('Heartbeat error: $e');
-      }
-
-      await Future.delayed(const Duration(seconds: 30));
-      return _isConnected;
-    });
-  }
-
   // Disconnect from the P2P server
   Future<bool> disconnect() async {
     if (!_isConnected || _peerId == null) return true;
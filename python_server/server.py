@@ -1,19 +1,34 @@
 import os
-import json
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
 import uuid
 import socket
 import logging
-import threading
-import requests
+import shutil
+import tempfile
 import time
 from datetime import datetime
+from typing import Union
+import msgspec
+import orjson
 from flask import Flask, request, jsonify, send_file
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
+from werkzeug.formparser import parse_form_data
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import FileWrapper
 import socketio
-import eventlet
+import redis
+import uvicorn
+from a2wsgi import WSGIMiddleware
 from pyngrok import ngrok
 
+from store import MemoryPeerStore, MemoryTable, RedisPeerStore, RedisTable
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -25,28 +40,199 @@ logging.basicConfig(
 )
 logger = logging.getLogger("BurrowSpaceP2P")
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # orjson already produces bytes, skip the str round trip of the default
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype
+        )
+
+class OrjsonSocketIO:
+    """Stand-in for the json module used to encode Socket.IO packets"""
+    
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+# Request bodies, decoded and validated in one pass by msgspec. Malformed JSON
+# or a missing or mistyped field raises msgspec.DecodeError.
+class ConnectRequest(msgspec.Struct):
+    user_id: str
+
+class TransferRequest(msgspec.Struct):
+    sender_id: str
+    receiver_id: str
+    filename: str
+
+class TransferStatusUpdate(msgspec.Struct):
+    status: str
+    progress: Union[int, float]
+
 # Flask application setup
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
+# Compress JSON responses such as /peers, preferring zstd and falling back to
+# gzip for clients that only accept that. Downloads are streamed responses and
+# are left as is, compressing them would drop Content-Length and range support.
+app.config['COMPRESS_ALGORITHM'] = ['zstd', 'br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_STREAMS'] = False
+Compress(app)
+
+# Shared state backend: set REDIS_URL to run several workers behind a load balancer
+REDIS_URL = os.environ.get('REDIS_URL')
+# Seconds a peer is kept online without a socket: after /connect until it
+# registers one, and in Redis after the worker holding its socket stops refreshing it
+PEER_TTL = 90
+PEER_TIME_FIELDS = ('connected_at', 'last_seen', 'disconnected_at')  # time.time() floats
+RECORD_TTL = 24 * 60 * 60  # Seconds transfer requests, transfers and relay sessions are kept
+MAX_RECORDS = 100000  # Per record type in memory, least recently used dropped beyond this
+TRANSFER_SWEEP_INTERVAL = 60 * 60  # Seconds between sweeps for uploads of expired transfers
+
+# With Redis each worker listens on its own pub/sub channel, so an event for a
+# peer is only decoded by the worker holding its socket. Number the workers
+# with WORKER_SHARD from 0 to WORKER_SHARDS - 1.
+WORKER_SHARDS = int(os.environ.get('WORKER_SHARDS', 1))
+WORKER_SHARD = int(os.environ.get('WORKER_SHARD', 0))
+
+# Socket.IO packet format: 'default' (JSON) or 'msgpack', which shrinks every
+# packet and carries relay chunks inline but needs a msgpack parser on the clients
+SOCKETIO_SERIALIZER = os.environ.get('SOCKETIO_SERIALIZER', 'default')
+
 # Socket.IO for real-time communication
-sio = socketio.Server(cors_allowed_origins='*')
-app.wsgi_app = socketio.WSGIApp(sio, app.wsgi_app)
+sio_options = {
+    'async_mode': 'asgi',
+    'cors_allowed_origins': '*',
+    'json': OrjsonSocketIO,
+    'serializer': SOCKETIO_SERIALIZER,
+    # Engine.IO pings every socket, so dead clients are dropped (and their peer
+    # marked offline by the disconnect handler) within ~40 seconds
+    'ping_interval': 10,
+    'ping_timeout': 30
+}
+# Publish-only managers for the channels of the other workers
+shard_managers = {}
+if REDIS_URL:
+    # Route emits through Redis pub/sub so they reach sockets held by other workers
+    sio_options['client_manager'] = socketio.AsyncRedisManager(
+        REDIS_URL, channel=f'socketio-{WORKER_SHARD}')
+    shard_managers = {
+        shard: socketio.AsyncRedisManager(REDIS_URL, channel=f'socketio-{shard}', write_only=True)
+        for shard in range(WORKER_SHARDS)
+        if shard != WORKER_SHARD
+    }
+sio = socketio.AsyncServer(**sio_options)
+
+# Event loop serving the sockets, set on startup
+main_loop = None
+
+# Peers whose sockets this worker holds: {sid: (peer_id, user_id)}
+local_peers = {}
+
+def serialize_peer(peer_data):
+    """Copy of a peer record with its timestamps converted to ISO strings"""
+    return {
+        field: datetime.fromtimestamp(value).isoformat() if field in PEER_TIME_FIELDS else value
+        for field, value in peer_data.items()
+    }
+
+def peer_room(peer_id):
+    """Name of the Socket.IO room joined by the socket of a peer"""
+    return f'peer:{peer_id}'
+
+def user_room(user_id):
+    """Name of the Socket.IO room joined by every socket of a user"""
+    return f'user:{user_id}'
+
+async def shard_emit(event, data, shard=None, **kwargs):
+    """Emit a Socket.IO event on the channel of one worker shard, or of all of them
+
+    Pass the shard stored in a peer's record for events addressed to that
+    peer; broadcasts and user rooms can span workers and go to every shard.
+    """
+    if shard is None or shard == WORKER_SHARD:
+        await sio.emit(event, data, **kwargs)
+    for other, manager in shard_managers.items():
+        if shard is None or shard == other:
+            await manager.emit(event, data, **kwargs)
+
+def emit(event, data, **kwargs):
+    """Emit a Socket.IO event from a Flask route
+
+    Flask routes run on a2wsgi's thread pool, so the emit is handed over to the
+    event loop that owns the sockets instead of being awaited here. Until the
+    ASGI lifespan startup has captured that loop (it never does with
+    ``--lifespan off`` or the Flask test client) events are dropped.
+    """
+    if main_loop is None:
+        return
+    asyncio.run_coroutine_threadsafe(shard_emit(event, data, **kwargs), main_loop)
+
+async def store_call(func, *args, **kwargs):
+    """Call a store method from a coroutine
+
+    The Redis stores make blocking round trips, so their calls are run on the
+    default executor instead of stalling every socket served by the event loop.
+    """
+    if not REDIS_URL:
+        return func(*args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(func, *args, **kwargs))
 
 # Server configuration
-UPLOAD_FOLDER = 'transfers'
+# Files uploaded for server-relayed transfers. With several workers this must be
+# storage shared by all of them and mounted at the same path, since the upload,
+# the download and the cancel of a transfer can each land on a different worker.
+UPLOAD_FOLDER = os.path.abspath(os.environ.get('UPLOAD_FOLDER', 'transfers'))
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 * 1024  # 16 GB max upload
+FILE_BUFFER_SIZE = 1024 * 1024  # 1 MB buffers for streaming uploads and downloads
+HAS_FADVISE = hasattr(os, 'posix_fadvise')  # Page cache hints, not available on Windows/macOS
+# Threads running the Flask routes. Each upload or download holds one for as
+# long as it runs, so this caps concurrent transfers plus other REST calls.
+HTTP_WORKERS = int(os.environ.get('HTTP_WORKERS', 64))
+
+def remove_transfer_files(transfer_id, transfer=None):
+    """Delete the upload directory of a transfer, if it has one"""
+    shutil.rmtree(os.path.join(UPLOAD_FOLDER, transfer_id), ignore_errors=True)
 
-# In-memory data stores
-connected_peers = {}  # Dictionary to store connected peers: {peer_id: {ip, port, user_id, status, socket_id}}
-transfer_requests = {}  # Dictionary to store transfer requests: {request_id: {status, sender_id, receiver_id, filename}}
-active_transfers = {}  # Dictionary to track active file transfers: {transfer_id: {progress, status, filename}}
-relay_sessions = {}  # Dictionary to track relay sessions: {session_id: {sender_id, receiver_id, status}}
+# Data stores, in Redis when REDIS_URL is set, otherwise in memory
+# connected_peers: {peer_id: {ip, port, user_id, status, socket_id, shard}}
+# transfer_requests: {request_id: {status, sender_id, receiver_id, filename}}
+# active_transfers: {transfer_id: {progress, status, filename}}
+# relay_sessions: {session_id: {sender_id, receiver_id, status}}
+if REDIS_URL:
+    redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    connected_peers = RedisPeerStore(redis_client, ttl=PEER_TTL)
+    transfer_requests = RedisTable(redis_client, 'transfer_request', ttl=RECORD_TTL)
+    active_transfers = RedisTable(redis_client, 'transfer', ttl=RECORD_TTL)
+    relay_sessions = RedisTable(redis_client, 'relay_session', ttl=RECORD_TTL)
+else:
+    connected_peers = MemoryPeerStore()
+    transfer_requests = MemoryTable(ttl=RECORD_TTL, maxsize=MAX_RECORDS)
+    active_transfers = MemoryTable(ttl=RECORD_TTL, maxsize=MAX_RECORDS,
+                                   on_evict=remove_transfer_files)
+    relay_sessions = MemoryTable(ttl=RECORD_TTL, maxsize=MAX_RECORDS)
 
 # Generate a server ID
-SERVER_ID = str(uuid.uuid4())
+SERVER_ID = uuid.uuid4().hex
 
 # NAT traversal configuration
 USE_NGROK = os.environ.get('USE_NGROK', 'False').lower() in ('true', '1', 't')
@@ -56,23 +242,46 @@ STUN_SERVERS = [
     'stun:stun2.l.google.com:19302'
 ]
 
+# TURN relay (e.g. coturn with use-auth-secret) so relayed file data bypasses
+# this server: comma-separated turn:/turns: URLs and the shared secret
+TURN_URLS = [url for url in os.environ.get('TURN_URLS', '').split(',') if url]
+TURN_SECRET = os.environ.get('TURN_SECRET')
+TURN_CREDENTIAL_TTL = 24 * 60 * 60  # Long enough for the largest transfers
+
 # Global server URL (will be updated when using ngrok)
 SERVER_URL = None
 
+def turn_credentials(user_id):
+    """Time-limited TURN credentials using coturn's REST API scheme"""
+    if not TURN_URLS or not TURN_SECRET:
+        return None
+    username = f"{int(time.time()) + TURN_CREDENTIAL_TTL}:{user_id}"
+    digest = hmac.new(TURN_SECRET.encode(), username.encode(), hashlib.sha1).digest()
+    return {
+        'urls': TURN_URLS,
+        'username': username,
+        'credential': base64.b64encode(digest).decode()
+    }
+
+@functools.lru_cache(maxsize=None)
 def get_ip():
-    """Get the server's local IP address"""
+    """Get the server's local IP address (probed once, then cached)"""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         # doesn't even have to be reachable
         s.connect(('10.255.255.255', 1))
         IP = s.getsockname()[0]
     except Exception:
-        IP = '127.0.0.1'
+        try:
+            IP = socket.gethostbyname(socket.gethostname())
+        except Exception:
+            IP = '127.0.0.1'
     finally:
         s.close()
     return IP
 
-SERVER_IP = get_ip()
+# Set SERVER_IP to skip the probe, e.g. when the outgoing interface isn't the advertised one
+SERVER_IP = os.environ.get('SERVER_IP') or get_ip()
 SERVER_PORT = 5000
 
 # Setup ngrok for global access if enabled
@@ -90,28 +299,47 @@ def setup_ngrok():
 
 # Socket.IO event handlers
 @sio.event
-def connect(sid, environ):
+async def connect(sid, environ):
     logger.info(f"Socket connected: {sid}")
 
 @sio.event
-def disconnect(sid):
+async def disconnect(sid):
     logger.info(f"Socket disconnected: {sid}")
-    # Update peer status if found
-    for peer_id, peer_data in list(connected_peers.items()):
-        if peer_data.get('socket_id') == sid:
-            connected_peers[peer_id]['status'] = 'offline'
-            connected_peers[peer_id]['disconnected_at'] = datetime.now().isoformat()
-            logger.info(f"Peer marked offline: {peer_id}")
-            # Notify other peers about this peer disconnection
-            sio.emit('peer_disconnected', {'peer_id': peer_id})
+    local_peers.pop(sid, None)
+    # Update peer status if this socket was registered to one
+    peer_id = (await sio.get_session(sid)).get('peer_id')
+    peer_data = await store_call(connected_peers.get, peer_id) if peer_id else None
+    if peer_data and peer_data.get('socket_id') == sid:
+        await store_call(connected_peers.update, peer_id, status='offline',
+                         disconnected_at=time.time())
+        logger.info(f"Peer marked offline: {peer_id}")
+        # Notify other peers about this peer disconnection
+        await shard_emit('peer_disconnected', {'peer_id': peer_id})
+
+async def expire_unregistered_peer(peer_id):
+    """Mark a peer offline if its client hasn't registered a socket within PEER_TTL"""
+    await sio.sleep(PEER_TTL)
+    peer_data = await store_call(connected_peers.get, peer_id)
+    if peer_data and peer_data['status'] == 'online' and 'socket_id' not in peer_data:
+        await store_call(connected_peers.update, peer_id, status='offline',
+                         disconnected_at=time.time())
+        logger.info(f"Peer never registered a socket, marked offline: {peer_id}")
+        await shard_emit('peer_disconnected', {'peer_id': peer_id})
 
 @sio.event
-def register_socket(sid, data):
+async def register_socket(sid, data):
     try:
         peer_id = data.get('peer_id')
-        if peer_id and peer_id in connected_peers:
-            connected_peers[peer_id]['socket_id'] = sid
-            connected_peers[peer_id]['last_seen'] = datetime.now().isoformat()
+        peer_data = await store_call(connected_peers.get, peer_id) if peer_id else None
+        if peer_data and await store_call(connected_peers.update, peer_id, socket_id=sid,
+                                          shard=WORKER_SHARD, status='online',
+                                          last_seen=time.time()):
+            await sio.save_session(sid, {'peer_id': peer_id})
+            local_peers[sid] = (peer_id, peer_data['user_id'])
+            # Events for the peer are sent to its room, which follows it across
+            # reconnects, and events for the user reach all their devices
+            await sio.enter_room(sid, peer_room(peer_id))
+            await sio.enter_room(sid, user_room(peer_data['user_id']))
             logger.info(f"Socket registered for peer: {peer_id}")
             return {'status': 'success'}
         return {'status': 'error', 'message': 'Invalid peer ID'}
@@ -120,73 +348,82 @@ def register_socket(sid, data):
         return {'status': 'error', 'message': str(e)}
 
 @sio.event
-def peer_signal(sid, data):
+async def peer_signal(sid, data):
     try:
         target_peer_id = data.get('target_peer_id')
         sender_peer_id = data.get('sender_peer_id')
         signal_data = data.get('signal')
         
-        if target_peer_id in connected_peers and 'socket_id' in connected_peers[target_peer_id]:
-            target_socket_id = connected_peers[target_peer_id]['socket_id']
-            sio.emit('peer_signal', {
+        target_peer = await store_call(connected_peers.get, target_peer_id)
+        if target_peer and 'socket_id' in target_peer:
+            await shard_emit('peer_signal', {
                 'sender_peer_id': sender_peer_id,
                 'signal': signal_data
-            }, room=target_socket_id)
+            }, shard=target_peer.get('shard'), room=peer_room(target_peer_id), skip_sid=sid)
             return {'status': 'success'}
         else:
             # Target peer not connected, store signal for later delivery
             # or initiate relay if direct connection isn't possible
-            initiate_relay(sender_peer_id, target_peer_id)
+            await initiate_relay(sender_peer_id, target_peer_id)
             return {'status': 'relay', 'message': 'Target peer unavailable, using relay'}
     except Exception as e:
         logger.error(f"Error in peer signaling: {str(e)}")
         return {'status': 'error', 'message': str(e)}
 
-def initiate_relay(sender_peer_id, receiver_peer_id):
+async def initiate_relay(sender_peer_id, receiver_peer_id):
     """Setup a relay session when direct P2P connection isn't possible"""
-    session_id = str(uuid.uuid4())
-    relay_sessions[session_id] = {
+    session_id = uuid.uuid4().hex
+    await store_call(relay_sessions.put, session_id, {
         'sender_id': sender_peer_id,
         'receiver_id': receiver_peer_id,
         'status': 'initiated',
         'created_at': datetime.now().isoformat()
-    }
+    })
     
-    # Notify sender that we're using relay
-    if sender_peer_id in connected_peers and 'socket_id' in connected_peers[sender_peer_id]:
-        sender_socket_id = connected_peers[sender_peer_id]['socket_id']
-        sio.emit('relay_initiated', {
-            'session_id': session_id,
-            'target_peer_id': receiver_peer_id
-        }, room=sender_socket_id)
+    # Notify sender that we're using relay, its socket is the one signalling
+    # through this worker
+    await sio.emit('relay_initiated', {
+        'session_id': session_id,
+        'target_peer_id': receiver_peer_id
+    }, room=peer_room(sender_peer_id))
     
     return session_id
 
 @sio.event
-def relay_chunk(sid, data):
-    """Handle file chunk relay when direct connection isn't possible"""
+async def relay_chunk(sid, data, chunk=None):
+    """Handle file chunk relay when direct connection isn't possible
+
+    Clients should emit ``(meta, chunk)`` with the chunk as raw bytes so it
+    travels as a binary attachment and is forwarded without being re-encoded.
+    The older single dict with a base64 ``chunk`` field is still accepted.
+    """
     try:
         session_id = data.get('session_id')
-        chunk_data = data.get('chunk')
         chunk_index = data.get('index')
         total_chunks = data.get('total')
         
-        if session_id in relay_sessions:
-            receiver_id = relay_sessions[session_id]['receiver_id']
+        relay_session = await store_call(relay_sessions.get, session_id)
+        if relay_session:
+            receiver = await store_call(connected_peers.get, relay_session['receiver_id'])
             
-            if receiver_id in connected_peers and 'socket_id' in connected_peers[receiver_id]:
+            if receiver and 'socket_id' in receiver:
                 # Forward the chunk to receiver
-                receiver_socket_id = connected_peers[receiver_id]['socket_id']
-                sio.emit('relay_chunk', {
-                    'session_id': session_id,
-                    'chunk': chunk_data,
-                    'index': chunk_index,
-                    'total': total_chunks
-                }, room=receiver_socket_id)
+                receiver_room = peer_room(relay_session['receiver_id'])
+                shard = receiver.get('shard')
+                if chunk is not None:
+                    await shard_emit('relay_chunk', (data, chunk), shard=shard,
+                                     room=receiver_room, skip_sid=sid)
+                else:
+                    await shard_emit('relay_chunk', {
+                        'session_id': session_id,
+                        'chunk': data.get('chunk'),
+                        'index': chunk_index,
+                        'total': total_chunks
+                    }, shard=shard, room=receiver_room, skip_sid=sid)
                 
                 # Update relay session status
                 if chunk_index == total_chunks - 1:  # Last chunk
-                    relay_sessions[session_id]['status'] = 'completed'
+                    await store_call(relay_sessions.update, session_id, status='completed')
                 
                 return {'status': 'success'}
             else:
@@ -216,21 +453,24 @@ def get_status():
 def connect_peer():
     """Endpoint for peers to connect to the server"""
     try:
-        data = request.json
-        if not data or 'user_id' not in data:
-            return jsonify({'error': 'Missing required parameters'}), 400
+        user_id = msgspec.json.decode(request.get_data(), type=ConnectRequest).user_id
+        
+        peer_id = uuid.uuid4().hex
+        now = time.time()
         
-        user_id = data['user_id']
-        peer_id = str(uuid.uuid4())
+        # Schedule the registration deadline first, so a peer is never stored
+        # without one. The check only reads the record after PEER_TTL.
+        if main_loop is not None:
+            asyncio.run_coroutine_threadsafe(expire_unregistered_peer(peer_id), main_loop)
         
         # Store peer information
-        connected_peers[peer_id] = {
+        connected_peers.put(peer_id, {
             'user_id': user_id,
             'ip': request.remote_addr,
-            'connected_at': datetime.now().isoformat(),
+            'connected_at': now,
             'status': 'online',
-            'last_seen': datetime.now().isoformat()
-        }
+            'last_seen': now
+        })
         
         logger.info(f"New peer connected: {peer_id} (User ID: {user_id})")
         
@@ -242,80 +482,68 @@ def connect_peer():
             'stun_servers': STUN_SERVERS,
             'public_url': SERVER_URL
         })
+    except msgspec.DecodeError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error connecting peer: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/heartbeat/<peer_id>', methods=['POST'])
-def heartbeat(peer_id):
-    """Endpoint for peers to send heartbeat and maintain connection"""
-    if peer_id not in connected_peers:
-        return jsonify({'error': 'Peer not found'}), 404
-    
-    connected_peers[peer_id]['last_seen'] = datetime.now().isoformat()
-    connected_peers[peer_id]['status'] = 'online'
-    
-    return jsonify({'status': 'ok'})
-
 @app.route('/peers', methods=['GET'])
 def get_peers():
     """Get list of connected peers"""
     # Optionally filter by user_id
     user_id = request.args.get('user_id')
-    result = {}
-    
-    for peer_id, peer_data in connected_peers.items():
-        if peer_data['status'] == 'online' and (not user_id or peer_data['user_id'] == user_id):
-            result[peer_id] = peer_data
     
     return jsonify({
-        'peers': result
+        'peers': {
+            peer_id: serialize_peer(peer_data)
+            for peer_id, peer_data in connected_peers.online(user_id).items()
+        }
     })
 
 @app.route('/request-transfer', methods=['POST'])
 def request_file_transfer():
     """Endpoint to request a file transfer between peers"""
     try:
-        data = request.json
-        if not data or 'sender_id' not in data or 'receiver_id' not in data or 'filename' not in data:
-            return jsonify({'error': 'Missing required parameters'}), 400
+        data = msgspec.json.decode(request.get_data(), type=TransferRequest)
         
-        sender_id = data['sender_id']
-        receiver_id = data['receiver_id']
-        filename = data['filename']
+        sender_id = data.sender_id
+        receiver_id = data.receiver_id
+        filename = data.filename
         
         # Generate a unique transfer request ID
-        request_id = str(uuid.uuid4())
+        request_id = uuid.uuid4().hex
         
         # Store the transfer request
-        transfer_requests[request_id] = {
+        transfer_requests.put(request_id, {
             'sender_id': sender_id,
             'receiver_id': receiver_id,
             'filename': filename,
             'status': 'pending',
             'created_at': datetime.now().isoformat()
-        }
+        })
         
         logger.info(f"New transfer request: {request_id} - {sender_id} -> {receiver_id} - {filename}")
         
         # Notify receiver about transfer request via Socket.IO if they're online
         receiver_peer_id = None
-        for peer_id, peer_data in connected_peers.items():
-            if peer_data['user_id'] == receiver_id and peer_data['status'] == 'online':
-                receiver_peer_id = peer_id
-                if 'socket_id' in peer_data:
-                    sio.emit('transfer_request', {
-                        'request_id': request_id,
-                        'sender_id': sender_id,
-                        'filename': filename
-                    }, room=peer_data['socket_id'])
-                break
+        for peer_id, peer_data in connected_peers.online(receiver_id).items():
+            receiver_peer_id = peer_id
+            if 'socket_id' in peer_data:
+                emit('transfer_request', {
+                    'request_id': request_id,
+                    'sender_id': sender_id,
+                    'filename': filename
+                }, shard=peer_data.get('shard'), room=peer_room(peer_id))
+            break
         
         return jsonify({
             'status': 'pending',
             'request_id': request_id,
             'receiver_online': receiver_peer_id is not None
         })
+    except msgspec.DecodeError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error requesting transfer: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -324,46 +552,50 @@ def request_file_transfer():
 def approve_transfer(request_id):
     """Endpoint for receiver to approve a file transfer request"""
     try:
-        if request_id not in transfer_requests:
+        transfer_request = transfer_requests.get(request_id)
+        if not transfer_request:
             return jsonify({'error': 'Transfer request not found'}), 404
         
         # Update the transfer request status
-        transfer_requests[request_id]['status'] = 'approved'
+        transfer_requests.update(request_id, status='approved')
         
         # Create a transfer ID for the approved request
-        transfer_id = str(uuid.uuid4())
+        transfer_id = uuid.uuid4().hex
         
         # Create an entry in active transfers
-        active_transfers[transfer_id] = {
+        active_transfers.put(transfer_id, {
             'request_id': request_id,
             'status': 'ready',
             'progress': 0,
             'created_at': datetime.now().isoformat(),
-            'sender_id': transfer_requests[request_id]['sender_id'],
-            'receiver_id': transfer_requests[request_id]['receiver_id'],
-            'filename': transfer_requests[request_id]['filename'],
+            'sender_id': transfer_request['sender_id'],
+            'receiver_id': transfer_request['receiver_id'],
+            'filename': transfer_request['filename'],
             'transfer_mode': 'p2p'  # Default to P2P mode
-        }
+        })
         
         # Notify sender via Socket.IO if they're online
-        sender_id = transfer_requests[request_id]['sender_id']
+        sender_id = transfer_request['sender_id']
         sender_peer_id = None
-        for peer_id, peer_data in connected_peers.items():
-            if peer_data['user_id'] == sender_id and peer_data['status'] == 'online':
-                sender_peer_id = peer_id
-                if 'socket_id' in peer_data:
-                    sio.emit('transfer_approved', {
-                        'request_id': request_id,
-                        'transfer_id': transfer_id
-                    }, room=peer_data['socket_id'])
-                break
+        for peer_id, peer_data in connected_peers.online(sender_id).items():
+            sender_peer_id = peer_id
+            if 'socket_id' in peer_data:
+                emit('transfer_approved', {
+                    'request_id': request_id,
+                    'transfer_id': transfer_id,
+                    'turn_server': turn_credentials(sender_id)
+                }, shard=peer_data.get('shard'), room=peer_room(peer_id))
+            break
         
         logger.info(f"Transfer request approved: {request_id} -> Transfer ID: {transfer_id}")
         
+        # Both peers get TURN credentials so a transfer that can't go direct is
+        # relayed by the TURN server instead of chunked through Socket.IO
         return jsonify({
             'status': 'approved',
             'transfer_id': transfer_id,
-            'sender_online': sender_peer_id is not None
+            'sender_online': sender_peer_id is not None,
+            'turn_server': turn_credentials(transfer_request['receiver_id'])
         })
     except Exception as e:
         logger.error(f"Error approving transfer: {str(e)}")
@@ -373,45 +605,82 @@ def approve_transfer(request_id):
 def upload_file(transfer_id):
     """Endpoint for sender to upload a file (fallback when P2P fails)"""
     try:
-        if transfer_id not in active_transfers:
+        transfer = active_transfers.get(transfer_id)
+        if not transfer:
             return jsonify({'error': 'Transfer not found or not approved'}), 404
         
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file part'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
-        
-        # Update transfer status
-        active_transfers[transfer_id]['status'] = 'transferring'
-        active_transfers[transfer_id]['transfer_mode'] = 'server_relay'
-        
-        # Secure the filename and save the file
-        filename = secure_filename(file.filename)
         transfer_dir = os.path.join(app.config['UPLOAD_FOLDER'], transfer_id)
         os.makedirs(transfer_dir, exist_ok=True)
         
-        file_path = os.path.join(transfer_dir, filename)
-        file.save(file_path)
+        # Stream file parts straight into the transfer directory instead of
+        # letting Werkzeug spool them to a temporary file and copying it again
+        parts = []
+        
+        def stream_factory(total_content_length, content_type, filename, content_length=None):
+            part = tempfile.NamedTemporaryFile(dir=transfer_dir, delete=False, buffering=FILE_BUFFER_SIZE)
+            parts.append(part)
+            return part
+        
+        try:
+            _, _, files = parse_form_data(
+                request.environ,
+                stream_factory=stream_factory,
+                max_content_length=app.config['MAX_CONTENT_LENGTH']
+            )
+            for part in parts:
+                part.close()
+            
+            if 'file' not in files:
+                return jsonify({'error': 'No file part'}), 400
+            
+            file = files['file']
+            if file.filename == '':
+                return jsonify({'error': 'No selected file'}), 400
+            
+            # Update transfer status
+            active_transfers.update(transfer_id, status='transferring', transfer_mode='server_relay')
+            
+            # Secure the filename and move the file into place
+            filename = secure_filename(file.filename)
+            file_path = os.path.abspath(os.path.join(transfer_dir, filename))
+            os.replace(file.stream.name, file_path)
+        finally:
+            # Drop any parts that weren't moved into place
+            for part in parts:
+                part.close()
+                if os.path.exists(part.name):
+                    os.remove(part.name)
+        
+        if HAS_FADVISE:
+            # The file is read back at most once, by the receiver, so drop it
+            # from the page cache instead of letting it crowd out other data.
+            # Dirty pages can't be dropped, hence the fdatasync first.
+            fd = os.open(file_path, os.O_RDONLY)
+            try:
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
         
         # Update transfer status
-        active_transfers[transfer_id]['status'] = 'completed'
-        active_transfers[transfer_id]['progress'] = 100
-        active_transfers[transfer_id]['file_path'] = file_path
-        active_transfers[transfer_id]['completed_at'] = datetime.now().isoformat()
+        active_transfers.update(
+            transfer_id,
+            status='completed',
+            progress=100,
+            file_path=file_path,
+            completed_at=datetime.now().isoformat()
+        )
         
         # Notify receiver via Socket.IO
-        receiver_id = active_transfers[transfer_id]['receiver_id']
-        for peer_id, peer_data in connected_peers.items():
-            if peer_data['user_id'] == receiver_id and peer_data['status'] == 'online':
-                if 'socket_id' in peer_data:
-                    sio.emit('transfer_completed', {
-                        'transfer_id': transfer_id,
-                        'filename': filename,
-                        'transfer_mode': 'server_relay'
-                    }, room=peer_data['socket_id'])
-                break
+        receiver_id = transfer['receiver_id']
+        for peer_id, peer_data in connected_peers.online(receiver_id).items():
+            if 'socket_id' in peer_data:
+                emit('transfer_completed', {
+                    'transfer_id': transfer_id,
+                    'filename': filename,
+                    'transfer_mode': 'server_relay'
+                }, shard=peer_data.get('shard'), room=peer_room(peer_id))
+            break
         
         logger.info(f"File uploaded for transfer {transfer_id}: {filename}")
         
@@ -424,14 +693,21 @@ def upload_file(transfer_id):
         logger.error(f"Error uploading file: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def download_file_wrapper(file, buffer_size):
+    """wsgi.file_wrapper streaming downloads in FILE_BUFFER_SIZE blocks"""
+    if HAS_FADVISE:
+        # Let the kernel read ahead aggressively, the file is read front to back
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return FileWrapper(file, FILE_BUFFER_SIZE)
+
 @app.route('/download/<transfer_id>', methods=['GET'])
 def download_file(transfer_id):
     """Endpoint for receiver to download a file (when P2P fails)"""
     try:
-        if transfer_id not in active_transfers:
+        transfer = active_transfers.get(transfer_id)
+        if not transfer:
             return jsonify({'error': 'Transfer not found'}), 404
         
-        transfer = active_transfers[transfer_id]
         if transfer['status'] != 'completed':
             return jsonify({'error': 'File not ready for download'}), 400
         
@@ -441,7 +717,10 @@ def download_file(transfer_id):
         
         logger.info(f"File download initiated for transfer {transfer_id}")
         
-        return send_file(file_path, as_attachment=True)
+        # Serve range requests so interrupted downloads can resume, and read the
+        # file in large blocks since each one is a separate send on the event loop
+        request.environ['wsgi.file_wrapper'] = download_file_wrapper
+        return send_file(file_path, as_attachment=True, conditional=True)
     except Exception as e:
         logger.error(f"Error downloading file: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -449,42 +728,37 @@ def download_file(transfer_id):
 @app.route('/transfer-status/<transfer_id>', methods=['GET'])
 def get_transfer_status(transfer_id):
     """Endpoint to check the status of a file transfer"""
-    if transfer_id not in active_transfers:
+    transfer = active_transfers.get(transfer_id)
+    if not transfer:
         return jsonify({'error': 'Transfer not found'}), 404
     
-    return jsonify(active_transfers[transfer_id])
+    return jsonify(transfer)
 
 @app.route('/update-transfer-status/<transfer_id>', methods=['POST'])
 def update_transfer_status(transfer_id):
     """Endpoint to update transfer status from peers"""
     try:
-        data = request.json
-        if not data or 'status' not in data or 'progress' not in data:
-            return jsonify({'error': 'Missing required parameters'}), 400
+        data = msgspec.json.decode(request.get_data(), type=TransferStatusUpdate)
         
-        if transfer_id not in active_transfers:
+        transfer = active_transfers.get(transfer_id)
+        if not transfer:
             return jsonify({'error': 'Transfer not found'}), 404
         
         # Update transfer status
-        active_transfers[transfer_id]['status'] = data['status']
-        active_transfers[transfer_id]['progress'] = data['progress']
+        active_transfers.update(transfer_id, status=data.status, progress=data.progress)
         
-        if data['status'] == 'completed':
-            active_transfers[transfer_id]['completed_at'] = datetime.now().isoformat()
+        if data.status == 'completed':
+            active_transfers.update(transfer_id, completed_at=datetime.now().isoformat())
             
             # Notify both sender and receiver
-            sender_id = active_transfers[transfer_id]['sender_id']
-            receiver_id = active_transfers[transfer_id]['receiver_id']
-            
-            for peer_id, peer_data in connected_peers.items():
-                if peer_data['user_id'] in [sender_id, receiver_id] and peer_data['status'] == 'online':
-                    if 'socket_id' in peer_data:
-                        sio.emit('transfer_completed', {
-                            'transfer_id': transfer_id,
-                            'transfer_mode': 'p2p'
-                        }, room=peer_data['socket_id'])
+            emit('transfer_completed', {
+                'transfer_id': transfer_id,
+                'transfer_mode': 'p2p'
+            }, room=[user_room(transfer['sender_id']), user_room(transfer['receiver_id'])])
         
         return jsonify({'status': 'updated'})
+    except msgspec.DecodeError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error updating transfer status: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -492,28 +766,23 @@ def update_transfer_status(transfer_id):
 @app.route('/cancel-transfer/<transfer_id>', methods=['POST'])
 def cancel_transfer(transfer_id):
     """Endpoint to cancel an ongoing transfer"""
-    if transfer_id not in active_transfers:
+    transfer = active_transfers.get(transfer_id)
+    if not transfer:
         return jsonify({'error': 'Transfer not found'}), 404
     
     # Update transfer status
-    active_transfers[transfer_id]['status'] = 'cancelled'
+    active_transfers.update(transfer_id, status='cancelled')
     
     # Remove the file if it exists and was using server relay
-    if active_transfers[transfer_id].get('transfer_mode') == 'server_relay' and 'file_path' in active_transfers[transfer_id]:
-        file_path = active_transfers[transfer_id]['file_path']
+    if transfer.get('transfer_mode') == 'server_relay' and 'file_path' in transfer:
+        file_path = transfer['file_path']
         if os.path.exists(file_path):
             os.remove(file_path)
     
     # Notify both sender and receiver
-    sender_id = active_transfers[transfer_id]['sender_id']
-    receiver_id = active_transfers[transfer_id]['receiver_id']
-    
-    for peer_id, peer_data in connected_peers.items():
-        if peer_data['user_id'] in [sender_id, receiver_id] and peer_data['status'] == 'online':
-            if 'socket_id' in peer_data:
-                sio.emit('transfer_cancelled', {
-                    'transfer_id': transfer_id
-                }, room=peer_data['socket_id'])
+    emit('transfer_cancelled', {
+        'transfer_id': transfer_id
+    }, room=[user_room(transfer['sender_id']), user_room(transfer['receiver_id'])])
     
     logger.info(f"Transfer cancelled: {transfer_id}")
     
@@ -525,12 +794,9 @@ def cancel_transfer(transfer_id):
 @app.route('/disconnect/<peer_id>', methods=['POST'])
 def disconnect_peer(peer_id):
     """Endpoint for peers to disconnect from the server"""
-    if peer_id not in connected_peers:
-        return jsonify({'error': 'Peer not found'}), 404
-    
     # Update peer status
-    connected_peers[peer_id]['status'] = 'offline'
-    connected_peers[peer_id]['disconnected_at'] = datetime.now().isoformat()
+    if not connected_peers.update(peer_id, status='offline', disconnected_at=time.time()):
+        return jsonify({'error': 'Peer not found'}), 404
     
     logger.info(f"Peer disconnected: {peer_id}")
     
@@ -539,26 +805,50 @@ def disconnect_peer(peer_id):
         'peer_id': peer_id
     })
 
-# Regular cleanup task to remove inactive peers
-def cleanup_inactive_peers():
+# Keep the Redis records of peers connected to this worker from expiring. If
+# the worker dies they stop being refreshed and expire after PEER_TTL.
+async def refresh_local_peers():
     while True:
+        await sio.sleep(PEER_TTL // 3)
         try:
-            now = datetime.now()
-            for peer_id, peer_data in list(connected_peers.items()):
-                if peer_data['status'] == 'online':
-                    last_seen = datetime.fromisoformat(peer_data['last_seen'])
-                    if (now - last_seen).total_seconds() > 60:  # 1 minute timeout
-                        connected_peers[peer_id]['status'] = 'offline'
-                        logger.info(f"Peer marked inactive: {peer_id}")
+            await store_call(connected_peers.refresh, dict(local_peers.values()))
         except Exception as e:
-            logger.error(f"Error in cleanup task: {str(e)}")
-        time.sleep(30)  # Run every 30 seconds
+            logger.error(f"Error refreshing peers: {str(e)}")
 
-if __name__ == '__main__':
-    # Start cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_inactive_peers, daemon=True)
-    cleanup_thread.start()
+def remove_orphaned_transfer_files():
+    """Delete uploads whose transfer record is gone
+
+    Covers transfers expired by Redis and uploads left behind by a restart of
+    the in-memory server. Directories are only removed once they haven't
+    changed for RECORD_TTL, by which time their record has expired anyway.
+    """
+    cutoff = time.time() - RECORD_TTL
+    for entry in os.scandir(UPLOAD_FOLDER):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff and entry.name not in active_transfers:
+            remove_transfer_files(entry.name)
+            logger.info(f"Removed files of expired transfer: {entry.name}")
+
+async def sweep_transfer_files():
+    while True:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, remove_orphaned_transfer_files)
+        except Exception as e:
+            logger.error(f"Error sweeping transfer files: {str(e)}")
+        await sio.sleep(TRANSFER_SWEEP_INTERVAL)
+
+def on_startup():
+    """Capture the event loop and start background tasks"""
+    global main_loop
+    main_loop = asyncio.get_running_loop()
     
+    sio.start_background_task(sweep_transfer_files)
+    if REDIS_URL:
+        sio.start_background_task(refresh_local_peers)
+
+# ASGI entry point: Socket.IO traffic goes to sio, everything else to Flask
+asgi_app = socketio.ASGIApp(sio, WSGIMiddleware(app, workers=HTTP_WORKERS), on_startup=on_startup)
+
+if __name__ == '__main__':
     # Setup ngrok if enabled
     if USE_NGROK:
         setup_ngrok()
@@ -568,5 +858,5 @@ if __name__ == '__main__':
     if SERVER_URL:
         logger.info(f"Public URL: {SERVER_URL}")
     
-    # Start the server
-    eventlet.wsgi.server(eventlet.listen(('0.0.0.0', SERVER_PORT)), app) 
\ No newline at end of file
+    # Start the server (uvloop and httptools are used when installed)
+    uvicorn.run(asgi_app, host='0.0.0.0', port=SERVER_PORT) 
\ No newline at end of file
@@ -0,0 +1,287 @@
+"""State stores for the BurrowSpace P2P server.
+
+Peers, transfer requests, active transfers and relay sessions live either in
+process-local dicts (the default, single worker) or in Redis when the server is
+started with ``REDIS_URL`` so that several workers can share the same state.
+Both backends expose the same small interface so the request handlers don't
+care which one is in use.
+"""
+import threading
+import time
+
+import orjson
+from cachetools import TTLCache
+
+
+class EvictingTTLCache(TTLCache):
+    """TTLCache that calls ``on_evict(key, value)`` for every item it drops
+    by itself, either expired or least recently used"""
+
+    def __init__(self, maxsize, ttl, on_evict=None):
+        super().__init__(maxsize, ttl)
+        self._on_evict = on_evict
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        if self._on_evict:
+            for key, value in expired:
+                self._on_evict(key, value)
+        return expired
+
+    def popitem(self):
+        key, value = super().popitem()
+        if self._on_evict:
+            self._on_evict(key, value)
+        return key, value
+
+
+class MemoryTable:
+    """Records kept in a process-local dict
+
+    With ``ttl`` set the records live in a TTLCache instead, which drops them
+    ``ttl`` seconds after their last write, or least recently used first once
+    it holds ``maxsize`` of them. ``on_evict(key, record)`` is called for each
+    record dropped that way.
+    """
+
+    def __init__(self, ttl=None, maxsize=None, on_evict=None):
+        self._records = EvictingTTLCache(maxsize, ttl, on_evict) if ttl else {}
+        # TTLCache reorders itself even on reads, and routes run on several threads
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._records
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def get(self, key):
+        """Return a copy of the record, or None if it doesn't exist"""
+        with self._lock:
+            record = self._records.get(key)
+            return dict(record) if record is not None else None
+
+    def put(self, key, record):
+        with self._lock:
+            self._records[key] = dict(record)
+
+    def update(self, key, **fields):
+        """Update fields of an existing record, returns False if it's missing"""
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                return False
+            record.update(fields)
+            # Store it again so the TTL runs from this write, as in Redis
+            self._records[key] = record
+            return True
+
+
+class MemoryPeerStore(MemoryTable):
+    """Connected peers kept in a process-local dict
+
+    ``_user_peers`` maps each user_id to its peer ids so per-user lookups
+    don't have to scan every peer.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._user_peers = {}
+
+    def put(self, key, record):
+        super().put(key, record)
+        self._user_peers.setdefault(record['user_id'], set()).add(key)
+
+    def online(self, user_id=None):
+        """Return {peer_id: record} for online peers, optionally for one user"""
+        # Snapshot the ids, routes run on several threads
+        if user_id:
+            peer_ids = list(self._user_peers.get(user_id, ()))
+        else:
+            peer_ids = list(self._records)
+        return {
+            peer_id: dict(self._records[peer_id])
+            for peer_id in peer_ids
+            if self._records[peer_id]['status'] == 'online'
+        }
+
+
+# Update an existing hash in one atomic step, so a record that expires between
+# the existence check and the write can't be recreated with only the updated
+# fields. Returns the previous values of the requested fields, or nil if the
+# hash doesn't exist.
+# KEYS: hash, index  ARGV: ttl, now, key, n, n field names, field/value pairs
+UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local n = tonumber(ARGV[4])
+local previous = {}
+if n > 0 then
+    previous = redis.call('HMGET', KEYS[1], unpack(ARGV, 5, 4 + n))
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 5 + n))
+local ttl = tonumber(ARGV[1])
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+    redis.call('ZADD', KEYS[2], tonumber(ARGV[2]) + ttl, ARGV[3])
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+else
+    redis.call('ZADD', KEYS[2], '+inf', ARGV[3])
+end
+return previous
+"""
+
+
+class RedisTable:
+    """Records kept as Redis hashes under ``<prefix>:<key>``
+
+    Field values are JSON-encoded (with orjson) so numbers and None survive
+    the round trip. With ``ttl`` set each record expires ``ttl`` seconds after
+    its last write. Every key is also listed in the ``<prefix>:index`` sorted
+    set, scored by its expiry time, so ``len()`` doesn't need a SCAN over the
+    keyspace.
+    """
+
+    def __init__(self, client, prefix, ttl=None):
+        self._redis = client
+        self._prefix = prefix
+        self._index = f'{prefix}:index'
+        self.ttl = ttl
+        self._update_script = client.register_script(UPDATE_SCRIPT)
+
+    def _key(self, key):
+        return f'{self._prefix}:{key}'
+
+    def _write(self, pipe, key, fields):
+        name = self._key(key)
+        pipe.hset(name, mapping={field: orjson.dumps(value) for field, value in fields.items()})
+        now = time.time()
+        if self.ttl:
+            pipe.expire(name, self.ttl)
+            pipe.zadd(self._index, {key: now + self.ttl})
+            pipe.zremrangebyscore(self._index, '-inf', now)
+        else:
+            pipe.zadd(self._index, {key: '+inf'})
+
+    def _update(self, key, fields, previous=()):
+        """Run UPDATE_SCRIPT, returning the previous values of the fields
+        named in ``previous`` or None if the record is missing"""
+        args = [self.ttl or 0, time.time(), key, len(previous), *previous]
+        for field, value in fields.items():
+            args += [field, orjson.dumps(value)]
+        return self._update_script(keys=[self._key(key), self._index], args=args)
+
+    def __contains__(self, key):
+        return bool(self._redis.exists(self._key(key)))
+
+    def __len__(self):
+        return self._redis.zcount(self._index, time.time(), '+inf')
+
+    def get(self, key):
+        """Return the decoded record, or None if it doesn't exist"""
+        raw = self._redis.hgetall(self._key(key))
+        if not raw:
+            return None
+        return {field: orjson.loads(value) for field, value in raw.items()}
+
+    def put(self, key, record):
+        pipe = self._redis.pipeline()
+        pipe.delete(self._key(key))
+        self._write(pipe, key, record)
+        pipe.execute()
+
+    def update(self, key, **fields):
+        """Update fields of an existing record, returns False if it's missing
+
+        Missing records are left alone so a late update can't resurrect one
+        that Redis has already evicted.
+        """
+        return self._update(key, fields) is not None
+
+
+class RedisPeerStore(RedisTable):
+    """Connected peers kept in Redis
+
+    Each peer is a ``peer:<peer_id>`` hash that expires ``ttl`` seconds after
+    its last update or ``refresh()``, so peers that are gone for good (e.g.
+    held by a worker that died) are evicted by Redis. ``peers:online`` holds
+    the ids of online peers and ``user:<user_id>:peers`` indexes peers by user.
+    """
+
+    ONLINE = 'peers:online'
+
+    def __init__(self, client, ttl):
+        super().__init__(client, 'peer', ttl)
+
+    @staticmethod
+    def _user_key(user_id):
+        return f'user:{user_id}:peers'
+
+    def _track(self, pipe, key, status):
+        if status == 'online':
+            pipe.sadd(self.ONLINE, key)
+        else:
+            pipe.srem(self.ONLINE, key)
+
+    def put(self, key, record):
+        user_key = self._user_key(record['user_id'])
+        pipe = self._redis.pipeline()
+        pipe.delete(self._key(key))
+        self._write(pipe, key, record)
+        self._track(pipe, key, record['status'])
+        pipe.sadd(user_key, key)
+        pipe.expire(user_key, self.ttl)
+        pipe.execute()
+
+    def update(self, key, **fields):
+        previous = self._update(key, fields, previous=('user_id', 'status'))
+        if previous is None:
+            return False
+        user_id, status = previous
+        user_key = self._user_key(orjson.loads(user_id))
+        pipe = self._redis.pipeline()
+        self._track(pipe, key, fields.get('status', orjson.loads(status)))
+        pipe.expire(user_key, self.ttl)
+        pipe.execute()
+        return True
+
+    def refresh(self, peers):
+        """Push back the expiry of peers given as {peer_id: user_id}"""
+        pipe = self._redis.pipeline()
+        for peer_id, user_id in peers.items():
+            pipe.expire(self._key(peer_id), self.ttl)
+            pipe.zadd(self._index, {peer_id: time.time() + self.ttl}, xx=True)
+            pipe.expire(self._user_key(user_id), self.ttl)
+        pipe.execute()
+
+    def online(self, user_id=None):
+        """Return {peer_id: record} for online peers, optionally for one user"""
+        if user_id:
+            peer_ids = self._redis.sinter(self._user_key(user_id), self.ONLINE)
+        else:
+            peer_ids = self._redis.smembers(self.ONLINE)
+        peer_ids = list(peer_ids)
+        if not peer_ids:
+            return {}
+
+        pipe = self._redis.pipeline()
+        for peer_id in peer_ids:
+            pipe.hgetall(self._key(peer_id))
+
+        result = {}
+        expired = []
+        for peer_id, raw in zip(peer_ids, pipe.execute()):
+            if raw:
+                result[peer_id] = {field: orjson.loads(value) for field, value in raw.items()}
+            else:
+                expired.append(peer_id)
+
+        # Drop ids whose hash has already been evicted
+        if expired:
+            self._redis.srem(self.ONLINE, *expired)
+            if user_id:
+                self._redis.srem(self._user_key(user_id), *expired)
+        return result